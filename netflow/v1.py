@@ -45,6 +45,14 @@ class V1DataFlow:
             self.data[field] = pack[idx]
         self.__dict__.update(self.data)  # Make data dict entries accessible as object attributes
 
+    @property
+    def src_ip_int(self):
+        return self.data['IPV4_SRC_ADDR']
+
+    @property
+    def dst_ip_int(self):
+        return self.data['IPV4_DST_ADDR']
+
     def __repr__(self):
         return "<DataRecord with data {}>".format(self.data)
 
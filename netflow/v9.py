@@ -13,8 +13,8 @@ Licensed under MIT License. See LICENSE.
 """
 
 import ipaddress
+import socket
 import struct
-import sys
 
 from .ipfix import IPFIXFieldTypes, IPFIXDataTypes
 
@@ -170,6 +170,24 @@ V9_SCOPE_TYPES = {
 }
 
 
+# Struct formats of the field lengths which struct.unpack converts to integers directly
+_V9_INT_FORMATS = {1: 'B', 2: 'H', 4: 'L', 8: 'Q'}
+_IPV4_STRUCT = struct.Struct('!L')
+
+
+def _ipv4_string(value: int) -> str:
+    return socket.inet_ntoa(_IPV4_STRUCT.pack(value))
+
+
+def _ip_address_string(value) -> str:
+    # IPv6 addresses arrive as 16 bytes, other lengths as integers or bytes, like ipaddress expects them
+    return ipaddress.ip_address(value).compressed
+
+
+def _bytes_to_int(value: bytes) -> int:
+    return int.from_bytes(value, 'big')
+
+
 class V9TemplateNotRecognized(KeyError):
     pass
 
@@ -180,10 +198,59 @@ class V9DataRecord:
     data dict keys (which are integers and can be mapped with the FIELD_TYPES
     dict).
     Should hold a 'data' dict with keys=field_type (integer) and value (in bytes).
+
+    The 'data' dict is built from the unpacked values and the template on first
+    access. The IPv4 addresses can be read as integers before, with src_ip_int and
+    dst_ip_int, so records can be filtered without converting all of their values.
     """
 
-    def __init__(self):
-        self.data = {}
+    def __init__(self, values=(), template=None):
+        self._values = values
+        self._template = template
+        self._data = None if template is not None else {}
+
+    @property
+    def data(self):
+        if self._data is None:
+            data = {}
+            for (fkey, convert), value in zip(self._template.converters, self._values):
+                if convert is None:
+                    # These values are already converted to numbers by struct.unpack
+                    data[fkey] = value
+                    continue
+                try:
+                    data[fkey] = convert(value)
+                except ValueError:
+                    print("IP address could not be parsed: {}".format(repr(value)))
+            self._data = data
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+    @property
+    def src_ip_int(self):
+        """The IPV4_SRC_ADDR as integer, or None if the record has none. Does not build 'data'."""
+        if self._template is None or self._template.ipv4_src_index is None:
+            return None
+        return self._values[self._template.ipv4_src_index]
+
+    @property
+    def dst_ip_int(self):
+        """The IPV4_DST_ADDR as integer, or None if the record has none. Does not build 'data'."""
+        if self._template is None or self._template.ipv4_dst_index is None:
+            return None
+        return self._values[self._template.ipv4_dst_index]
+
+    def __getattr__(self, name):
+        # Make data dict entries accessible as object attributes
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self.data[name]
+        except KeyError:
+            raise AttributeError(name) from None
 
     def __repr__(self):
         return "<DataRecord with data: {}>".format(self.data)
@@ -207,60 +274,17 @@ class V9DataFlowSet:
         # As the field lengths are variable V9 has padding to next 32 Bit
         padding_size = 4 - (self.length % 4)  # 4 Byte
 
-        # For performance reasons, we use struct.unpack to get individual values. Here
-        # we prepare the format string for parsing it. The format string is based on the template fields and their
-        # lengths. The string can then be re-used for every data record in the data stream
-        struct_format = '!'
-        struct_len = 0
-        for field in template.fields:
-            # The length of the value byte slice is defined in the template
-            flen = field.field_length
-            if flen == 4:
-                struct_format += 'L'
-            elif flen == 2:
-                struct_format += 'H'
-            elif flen == 1:
-                struct_format += 'B'
-            else:
-                struct_format += '%ds' % flen
-            struct_len += flen
+        # The unpacker is prepared once per template, see V9TemplateRecord.
+        # It is re-used for every data record in the data stream
+        unpack_from = template.unpacker.unpack_from
+        struct_len = template.unpacker.size
 
         while offset <= (self.length - padding_size):
-            # Here we actually unpack the values, the struct format string is used in every data record
-            # iteration, until the final offset reaches the end of the whole data stream
-            unpacked_values = struct.unpack(struct_format, data[offset:offset + struct_len])
-
-            new_record = V9DataRecord()
-            for field, value in zip(template.fields, unpacked_values):
-                flen = field.field_length
-                fkey = V9_FIELD_TYPES[field.field_type]
-
-                # Special handling of IP addresses to convert integers to strings to not lose precision in dump
-                # TODO: might only be needed for IPv6
-                if field.field_type in V9_FIELD_TYPES_CONTAINING_IP:
-                    try:
-                        ip = ipaddress.ip_address(value)
-                    except ValueError:
-                        print("IP address could not be parsed: {}".format(repr(value)))
-                        continue
-                    new_record.data[fkey] = ip.compressed
-                elif flen in (1, 2, 4):
-                    # These values are already converted to numbers by struct.unpack:
-                    new_record.data[fkey] = value
-                else:
-                    # Caveat: this code assumes little-endian system (like x86)
-                    if sys.byteorder != "little":
-                        print("v9.py uses bit shifting for little endianness. Your processor is not little endian")
-
-                    fdata = 0
-                    for idx, byte in enumerate(reversed(bytearray(value))):
-                        fdata += byte << (idx * 8)
-                    new_record.data[fkey] = fdata
-
-                offset += flen
-
-            new_record.__dict__.update(new_record.data)
-            self.flows.append(new_record)
+            # Here we actually unpack the values, the struct format is used in every data record
+            # iteration, until the final offset reaches the end of the whole data stream.
+            # Converting the values is left to the record, when its data is accessed
+            self.flows.append(V9DataRecord(unpack_from(data, offset), template))
+            offset += struct_len
 
     def __repr__(self):
         return "<DataFlowSet with template {} of length {} holding {} flows>" \
@@ -289,6 +313,48 @@ class V9TemplateRecord:
         self.field_count = field_count
         self.fields = fields
 
+        # For performance reasons, the struct used to unpack the data records of this template and
+        # the conversion of each unpacked value are prepared once here. The format is based on the
+        # template fields and their lengths. A converter of None means the unpacked value is used as is.
+        struct_format = '!'
+        self.converters = []
+        # Positions of the IPv4 addresses in the unpacked values, to read them without converting the record
+        self.ipv4_src_index = None
+        self.ipv4_dst_index = None
+        for idx, field in enumerate(fields):
+            # The length of the value byte slice is defined in the template
+            flen = field.field_length
+            fkey = V9_FIELD_TYPES[field.field_type]
+            if field.field_type in V9_FIELD_TYPES_CONTAINING_IP:
+                # Special handling of IP addresses to convert them to strings to not lose precision in dump
+                if flen == 4:
+                    struct_format += 'L'
+                    self.converters.append((fkey, _ipv4_string))
+                    if fkey == 'IPV4_SRC_ADDR':
+                        self.ipv4_src_index = idx
+                    elif fkey == 'IPV4_DST_ADDR':
+                        self.ipv4_dst_index = idx
+                    continue
+                struct_format += 'B' if flen == 1 else 'H' if flen == 2 else '%ds' % flen
+                self.converters.append((fkey, _ip_address_string))
+            elif flen in _V9_INT_FORMATS:
+                struct_format += _V9_INT_FORMATS[flen]
+                self.converters.append((fkey, None))
+            else:
+                struct_format += '%ds' % flen
+                self.converters.append((fkey, _bytes_to_int))
+        self.unpacker = struct.Struct(struct_format)
+
+    def __getstate__(self):
+        # struct.Struct can not be pickled, it is rebuilt from its format
+        state = self.__dict__.copy()
+        state['unpacker'] = self.unpacker.format
+        return state
+
+    def __setstate__(self, state):
+        state['unpacker'] = struct.Struct(state['unpacker'])
+        self.__dict__.update(state)
+
     def __repr__(self):
         return "<TemplateRecord {} with {} fields: {}>".format(
             self.template_id, self.field_count,
@@ -418,7 +484,7 @@ class V9OptionsDataFlowset:
 
                 value = None
                 if is_bytes:
-                    value = data[offset:offset + length]
+                    value = bytes(data[offset:offset + length])  # copy, data might be a view of a reused buffer
                 else:
                     value = int.from_bytes(data[offset:offset + length], 'big')
 
@@ -9,28 +9,54 @@ Licensed under MIT License. See LICENSE.
 """
 import os 
 import argparse
+import concurrent.futures
+import functools
+import gc
 import gzip
-import json
 import logging
 import ipaddress
+import json
+import orjson
+import platform
 import queue
 import signal
 import socket
-import socketserver
+import struct
+import sys
 import threading
 import requests
 import time
-from collections import namedtuple
+from collections import deque, namedtuple
 
 from .ipfix import IPFIXTemplateNotRecognized
 from .utils import UnknownExportVersion, parse_packet
 from .v9 import V9TemplateNotRecognized
 
-RawPacket = namedtuple('RawPacket', ['ts', 'client', 'data'])
+# Received packets are passed to the parser as plain (ts, client, data, buffer) tuples, which are
+# cheaper to create than namedtuples. 'buffer' is the index of the listener's receive buffer that
+# 'data' is a view of, or None.
 ParsedPacket = namedtuple('ParsedPacket', ['ts', 'client', 'export'])
 
 # Amount of time to wait before dropping an undecodable ExportPacket
 PACKET_TIMEOUT = 60 * 60
+# Amount of undecodable ExportPackets kept for re-attempts when new templates arrive
+MAX_RETRY_PACKETS = 1024
+# Amount of parsed ExportPackets waiting for the consumer, newer ones are dropped while it is full
+MAX_OUTPUT_PACKETS = 4096
+# Kernel receive timestamps with nanosecond precision (CLOCK_REALTIME like time.time()). Opt-in, as the
+# ancillary data costs more per datagram than the clock read it replaces. Older socket modules do not export
+# the constant, 35 is the generic Linux value. Alpha, PA-RISC and SPARC use their own values
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", None)
+if SO_TIMESTAMPNS is None and sys.platform.startswith("linux") \
+        and not platform.machine().startswith(("alpha", "parisc", "sparc")):
+    SO_TIMESTAMPNS = 35
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+TIMESPEC = struct.Struct("ll")  # struct timespec, seconds and nanoseconds
+
+# Size of the write buffer below the compression stream of the output files
+WRITE_BUFFER_SIZE = 1024 * 1024
+# Connect and read timeouts of the API requests in seconds, so a stalled server cannot block the upload thread
+REQUEST_TIMEOUT = (10, 120)
 
 logger = logging.getLogger("netflow-collector")
 ch = logging.StreamHandler()
@@ -39,28 +65,246 @@ ch.setFormatter(formatter)
 logger.addHandler(ch)
 
 
-class QueuingRequestHandler(socketserver.BaseRequestHandler):
-    def handle(self):
-        data = self.request[0]  # get content, [1] would be the socket
-        self.server.queue.put(RawPacket(time.time(), self.client_address, data))
-        logger.debug(
-            "Received %d bytes of data from %s", len(data), self.client_address
-        )
+def receive_time(ancdata) -> float:
+    """Get the kernel receive timestamp of a datagram from the ancillary data of recvmsg.
+    Falls back to the current time if the kernel did not deliver one.
+    """
+    for level, kind, cdata in ancdata:
+        if level == socket.SOL_SOCKET and kind == SCM_TIMESTAMPNS:
+            sec, nsec = TIMESPEC.unpack(cdata)
+            return sec + nsec / 1e9
+    return time.time()
+
+
+def pin_to_cpu(cpu):
+    """Pin the calling thread to a CPU, to keep its caches warm. Does nothing if cpu is None.
+    On Linux, pid 0 refers to the calling thread only, not to the whole process.
+    """
+    if cpu is None:
+        return
+    os.sched_setaffinity(0, {cpu})
+    logger.debug("Pinned thread %s to CPU %d", threading.current_thread().name, cpu)
+
+
+class SPSCRing:
+    """A fixed size single-producer/single-consumer ring buffer.
 
+    The producer only ever writes 'head' and the consumer only ever writes
+    'tail', so no lock is needed: under the GIL, the slot assignment and the
+    index update are each atomic and happen in program order.
+    """
 
-class QueuingUDPListener(socketserver.ThreadingUDPServer):
-    """A threaded UDP server that adds a (time, data) tuple to a queue for
-    every request it sees
+    def __init__(self, size):
+        if size & (size - 1):
+            raise ValueError("Ring size must be a power of two, got {}".format(size))
+        self._slots = [None] * size
+        self._mask = size - 1
+        self._head = 0  # next slot to write, only modified by the producer
+        self._tail = 0  # next slot to read, only modified by the consumer
+
+    def put(self, item) -> bool:
+        """Add an item, returns False if the ring is full"""
+        head = self._head
+        if head - self._tail > self._mask:
+            return False
+        self._slots[head & self._mask] = item
+        self._head = head + 1
+        return True
+
+    def get(self):
+        """Remove and return the oldest item, or None if the ring is empty"""
+        tail = self._tail
+        if tail == self._head:
+            return None
+        idx = tail & self._mask
+        item = self._slots[idx]
+        self._slots[idx] = None
+        self._tail = tail + 1
+        return item
+
+    def __len__(self):
+        return self._head - self._tail
+
+
+class QueuingUDPListener:
+    """A UDP listener that adds a (ts, client, data, buffer) tuple to a ring buffer
+    for every datagram it receives.
+
+    Each receiver thread owns one socket and loops over recvfrom, instead of
+    spawning a thread per datagram. With more than one receiver, the sockets
+    are bound with SO_REUSEPORT and the kernel spreads the exporters across them.
+
+    Datagrams are received into a fixed pool of preallocated buffers and queued
+    as memoryviews. The consumer hands a buffer back with release() once the
+    packet is parsed.
+
+    Every receiver has its own SPSCRing, the single consumer takes packets
+    from all of them with get(). Each queued packet holds a pooled buffer, so
+    the pool bounds the number of queued packets and the memory usage: packets
+    arriving while all buffers are in use are dropped and counted in 'dropped'.
+    The consumer is only woken through an event if it actually went to sleep
+    on empty rings.
     """
 
-    def __init__(self, interface, queue):
-        self.queue = queue
+    # Large kernel receive buffer to absorb bursts, capped by net.core.rmem_max
+    RCVBUF_SIZE = 16 * 1024 * 1024
+    # Pooled receive buffers, sized for exports sent in jumbo frames. Larger datagrams are dropped
+    BUFFER_SIZE = 9216
+    BUFFER_COUNT = 2048
+    # Capacity of each receiver's ring, must be a power of two. It has a slot for every buffer, so it never fills
+    RING_SIZE = BUFFER_COUNT
+
+    def __init__(self, interface, receivers=1, cpus=None, kernel_timestamps=False):
+        # Optional CPU for each receiver thread to pin itself to
+        self.cpus = cpus or [None] * receivers
+        if kernel_timestamps and SO_TIMESTAMPNS is None:
+            logger.warning("Kernel receive timestamps are not supported on this platform")
+            kernel_timestamps = False
+        self.kernel_timestamps = kernel_timestamps
+        self._shutdown = threading.Event()
+        self._ready = threading.Event()
+        self._waiting = False  # set by the consumer before it waits for self._ready
+        self._next_ring = 0
 
         # If IPv6 interface addresses are used, override the default AF_INET family
-        if ":" in interface[0]:
-            self.address_family = socket.AF_INET6
+        family = socket.AF_INET6 if ":" in interface[0] else socket.AF_INET
+
+        self.sockets = []
+        for _ in range(receivers):
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+            if receivers > 1:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF_SIZE)
+            # Kernel side receive timeout, so the shutdown flag is checked without polling before each recvfrom
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack("ll", 0, 500000))
+            if kernel_timestamps:
+                sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            sock.bind(interface)
+            self.sockets.append(sock)
+        # Space for the ancillary data carrying the receive timestamp of a datagram
+        self._ancbufsize = socket.CMSG_SPACE(TIMESPEC.size)
+
+        self.buffers = [bytearray(self.BUFFER_SIZE) for _ in range(self.BUFFER_COUNT)]
+        self._views = [memoryview(buf) for buf in self.buffers]
+        # Indices of unused buffers. deque.popleft/append are atomic, no lock needed between receivers and consumer
+        self._free = deque(range(self.BUFFER_COUNT))
+
+        self.rings = [SPSCRing(self.RING_SIZE) for _ in self.sockets]
+        self._dropped = [0] * len(self.sockets)  # per receiver, so each counter has a single writer
+        self._oversized = [0] * len(self.sockets)
+        self.threads = [threading.Thread(target=self._receive, args=(number, sock, ring))
+                        for number, (sock, ring) in enumerate(zip(self.sockets, self.rings))]
+
+    @property
+    def dropped(self):
+        """Number of packets dropped because the parser could not keep up"""
+        return sum(self._dropped)
+
+    @property
+    def oversized(self):
+        """Number of datagrams dropped because they were larger than the receive buffers"""
+        return sum(self._oversized)
+
+    def _receive(self, number, sock, ring):
+        pin_to_cpu(self.cpus[number])
+        put = ring.put
+        free = self._free
+        views = self._views
+        ancbufsize = self._ancbufsize
+        kernel_timestamps = self.kernel_timestamps
+        ancdata = None
+        scratch = bytearray(self.BUFFER_SIZE)  # receives the datagrams dropped while all buffers are in use
+        while not self._shutdown.is_set():
+            try:
+                idx = free.popleft()
+                buf = self.buffers[idx]
+            except IndexError:
+                idx = None  # all buffers are in use
+                buf = scratch
+
+            try:
+                # MSG_TRUNC returns the real datagram length, to detect exports larger than the buffer
+                if kernel_timestamps:
+                    size, ancdata, _, client = sock.recvmsg_into([buf], ancbufsize, socket.MSG_TRUNC)
+                else:
+                    size, client = sock.recvfrom_into(buf, 0, socket.MSG_TRUNC)
+            except BlockingIOError:
+                self.release(idx)
+                continue  # receive timeout
+            if size > self.BUFFER_SIZE:
+                self.release(idx)
+                self._oversized[number] += 1
+                if self._oversized[number] % 1000 == 1:
+                    logger.warning("Dropping a datagram of %d bytes from %s, larger than the receive buffer, "
+                                   "dropped %d so far", size, client, self.oversized)
+                continue
+            if idx is None:
+                # The parser holds on to every buffer: drop instead of blocking, so the backlog stays in
+                # the kernel socket buffer where drops show up in the UDP counters
+                self._drop(number)
+                continue
+            data = views[idx][:size]
+
+            ts = time.time() if ancdata is None else receive_time(ancdata)
+            put((ts, client, data, idx))  # cannot fail, see RING_SIZE
+            if self._waiting:
+                self._ready.set()
+            logger.debug("Received %d bytes of data from %s", len(data), client)
+
+    def _drop(self, number):
+        self._dropped[number] += 1
+        if self._dropped[number] % 1000 == 1:
+            logger.warning("Parser is falling behind, dropped %d packets so far", self.dropped)
+
+    def _poll(self):
+        rings = self.rings
+        count = len(rings)
+        start = self._next_ring
+        for i in range(count):
+            pkt = rings[(start + i) % count].get()
+            if pkt is not None:
+                # Continue with the next ring on the following call, so no receiver is starved
+                self._next_ring = (start + i + 1) % count
+                return pkt
+        return None
+
+    def get(self, timeout=None) -> tuple:
+        """Get the next received packet. Blocks at most 'timeout' seconds and
+        raises queue.Empty if no packet arrived in that time.
+        """
+        pkt = self._poll()
+        if pkt is None:
+            self._waiting = True
+            self._ready.clear()
+            # Check again, a receiver might have added a packet before it saw self._waiting
+            pkt = self._poll()
+            if pkt is None:
+                self._ready.wait(timeout)
+                pkt = self._poll()
+            self._waiting = False
+            if pkt is None:
+                raise queue.Empty
+        return pkt
+
+    def release(self, idx):
+        """Return a receive buffer to the pool once its packet was processed"""
+        if idx is not None:
+            self._free.append(idx)
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def shutdown(self):
+        self._shutdown.set()
 
-        super().__init__(interface, QueuingRequestHandler)
+    def join(self, timeout=None):
+        for thread in self.threads:
+            thread.join(timeout=timeout)
+
+    def server_close(self):
+        for sock in self.sockets:
+            sock.close()
 
 
 class ThreadedNetFlowListener(threading.Thread):
@@ -91,13 +335,29 @@ class ThreadedNetFlowListener(threading.Thread):
     ...     print("Stopped!")
     """
 
-    def __init__(self, host: str, port: int):
+    def __init__(self, host: str, port: int, receivers: int = 1, prefilter=None, pin_cpus: bool = False,
+                 kernel_timestamps: bool = False):
         logger.info("Starting the NetFlow listener on {}:{}".format(host, port))
-        self.output = queue.Queue()
-        self.input = queue.Queue()
-        self.server = QueuingUDPListener((host, port), self.input)
-        self.thread = threading.Thread(target=self.server.serve_forever)
-        self.thread.start()
+        # Optional callable, called with the raw data of each packet. Packets it returns False for are not parsed
+        self.prefilter = prefilter
+        self.output = queue.Queue(maxsize=MAX_OUTPUT_PACKETS)
+        self.evicted = 0  # undecodable packets dropped from the full retry list
+        self.dropped = 0  # parsed packets dropped because the consumer could not keep up
+
+        # With pin_cpus, the parser thread is pinned to the first allowed CPU and the receivers share the others.
+        # Other threads, like the consumer of the parsed packets, stay unpinned and may still run on any of them
+        self.cpu = None
+        receiver_cpus = None
+        if pin_cpus:
+            cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+            if len(cpus) < 2:
+                logger.warning("Not pinning threads to CPUs, at least two usable CPUs are needed")
+            else:
+                self.cpu = cpus[0]
+                receiver_cpus = [cpus[1 + i % (len(cpus) - 1)] for i in range(receivers)]
+
+        self.server = QueuingUDPListener((host, port), receivers, receiver_cpus, kernel_timestamps)
+        self.server.start()
         self._shutdown = threading.Event()
         super().__init__()
 
@@ -115,33 +375,50 @@ class ThreadedNetFlowListener(threading.Thread):
         return self.output.get(block, timeout)
 
     def run(self):
+        pin_to_cpu(self.cpu)
         # Process packets from the queue
         try:
             # TODO: use per-client templates
             templates = {"netflow": {}, "ipfix": {}}
-            to_retry = []
+            # Bounded, the oldest undecodable packets are evicted first
+            to_retry = deque(maxlen=MAX_RETRY_PACKETS)
             while not self._shutdown.is_set():
                 try:
                     # 0.5s delay to limit CPU usage while waiting for new packets
-                    pkt = self.input.get(block=True, timeout=0.5)  # type: RawPacket
+                    ts, client, data, buffer = self.server.get(timeout=0.5)
                 except queue.Empty:
                     continue
 
+                if self.prefilter is not None and not self.prefilter(data):
+                    self.server.release(buffer)
+                    continue
+
                 try:
                     # templates is passed as reference, updated in V9ExportPacket
-                    export = parse_packet(pkt.data, templates)
+                    export = parse_packet(data, templates)
                 except UnknownExportVersion as e:
-                    logger.error("%s, ignoring the packet", e)
+                    # The exception's message would only show the repr of the memoryview, not the data
+                    logger.error("Unknown NetFlow version %d for data %r..., ignoring the packet",
+                                 e.version, bytes(data[:16]))
                     continue
                 except (V9TemplateNotRecognized, IPFIXTemplateNotRecognized):
                     # TODO: differentiate between v9 and IPFIX, use separate to_retry lists
-                    if time.time() - pkt.ts > PACKET_TIMEOUT:
+                    if time.time() - ts > PACKET_TIMEOUT:
                         logger.warning("Dropping an old and undecodable v9/IPFIX ExportPacket")
                     else:
-                        to_retry.append(pkt)
+                        if len(to_retry) == to_retry.maxlen:
+                            self.evicted += 1
+                            if self.evicted % 1000 == 1:
+                                logger.warning("Too many undecodable v9/IPFIX ExportPackets, dropped the "
+                                               "oldest %d so far", self.evicted)
+                        # Copy the data, the receive buffer must not be held until a template arrives
+                        to_retry.append((ts, client, bytes(data), None))
                         logger.debug("Failed to decode a v9/IPFIX ExportPacket - will "
                                      "re-attempt when a new template is discovered")
                     continue
+                finally:
+                    # Parsed exports do not reference the received data, so the buffer can be reused
+                    self.server.release(buffer)
 
                 if export.header.version == 10:
                     logger.debug("Processed an IPFIX ExportPacket with length %d.", export.header.length)
@@ -149,32 +426,66 @@ class ThreadedNetFlowListener(threading.Thread):
                     logger.debug("Processed a v%d ExportPacket with %d flows.",
                                  export.header.version, export.header.count)
 
-                # If any new templates were discovered, dump the unprocessable
-                # data back into the queue and try to decode them again
+                self._output(ParsedPacket(ts, client, export))
+
+                # If any new templates were discovered, try to decode the unprocessable data again
                 if export.header.version in [9, 10] and export.contains_new_templates and to_retry:
                     logger.debug("Received new template(s)")
-                    logger.debug("Will re-attempt to decode %d old v9/IPFIX ExportPackets", len(to_retry))
-                    for p in to_retry:
-                        self.input.put(p)
-                    to_retry.clear()
-
-                self.output.put(ParsedPacket(pkt.ts, pkt.client, export))
+                    self._retry(to_retry, templates)
         finally:
             # Only reached when while loop ends
             self.server.shutdown()
+            self.server.join()
             self.server.server_close()
 
+    def _output(self, pkt):
+        try:
+            self.output.put_nowait(pkt)
+        except queue.Full:
+            # Parsed exports are larger than the raw data, they must not pile up without limit
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning("Consumer is falling behind, dropped %d parsed packets so far", self.dropped)
+
+    def _retry(self, to_retry, templates):
+        """Re-attempt to decode the packets in to_retry in place, without passing them through
+        the input again. Packets which still cannot be decoded remain in to_retry.
+        """
+        new_templates = True
+        while new_templates and to_retry:
+            logger.debug("Will re-attempt to decode %d old v9/IPFIX ExportPackets", len(to_retry))
+            new_templates = False
+            remaining = []
+            for pkt in to_retry:
+                ts, client, data, _ = pkt
+                try:
+                    export = parse_packet(data, templates)
+                except (V9TemplateNotRecognized, IPFIXTemplateNotRecognized):
+                    if time.time() - ts > PACKET_TIMEOUT:
+                        logger.warning("Dropping an old and undecodable v9/IPFIX ExportPacket")
+                    else:
+                        remaining.append(pkt)
+                    continue
+                # A decoded packet might carry templates for the remaining ones, then go again
+                new_templates = new_templates or export.contains_new_templates
+                self._output(ParsedPacket(ts, client, export))
+            to_retry.clear()
+            to_retry.extend(remaining)
+
     def stop(self):
         logger.info("Shutting down the NetFlow listener")
         self._shutdown.set()
 
     def join(self, timeout=None):
-        self.thread.join(timeout=timeout)
+        self.server.join(timeout=timeout)
         super().join(timeout=timeout)
 
 
-def get_export_packets(host: str, port: int) -> ParsedPacket:
-    """A threaded generator that will yield ExportPacket objects until it is killed
+def get_export_packets(host: str, port: int, receivers: int = 1, prefilter=None, pin_cpus: bool = False,
+                       tick: float = None, kernel_timestamps: bool = False) -> ParsedPacket:
+    """A threaded generator that will yield ExportPacket objects until it is killed.
+    If 'tick' is set, it yields None whenever no packet arrived for 'tick' seconds,
+    so periodic work still runs while the prefilter discards all exports.
     """
     def handle_signal(s, f):
         logger.debug("Received signal {}, raising StopIteration".format(s))
@@ -182,33 +493,249 @@ def get_export_packets(host: str, port: int) -> ParsedPacket:
     signal.signal(signal.SIGTERM, handle_signal)
     signal.signal(signal.SIGINT, handle_signal)
 
-    listener = ThreadedNetFlowListener(host, port)
+    listener = ThreadedNetFlowListener(host, port, receivers, prefilter, pin_cpus, kernel_timestamps)
     listener.start()
 
     try:
         while True:
-            yield listener.get()
+            try:
+                yield listener.get(timeout=tick)
+            except queue.Empty:
+                yield None
     except StopIteration:
         pass
     finally:
         listener.stop()
         listener.join()
 
-def filename(epoch): 
-    return "{}.gz".format(epoch)
+def filename(epoch, compressor=None):
+    return "{}.{}".format(epoch, "zst" if compressor is not None else "gz")
 
-def cidr_blocks_from_request(response): 
+def zstd_compressor(dictionary_path=None):
+    """Create the zstd compressor for the epoch files, optionally with a dictionary
+    trained on sample output (e.g. 'zstd --train samples/* -o netflow.zdict').
+    """
+    import zstandard  # optional, only needed if zstd compression is configured
+    dict_data = None
+    if dictionary_path:
+        with open(dictionary_path, "rb") as fh:
+            dict_data = zstandard.ZstdCompressionDict(fh.read())
+    return zstandard.ZstdCompressor(level=3, dict_data=dict_data)
+
+def open_epoch_file(epoch, compressor=None):
+    """Open the compressed file of an epoch for appending, gzip compressed unless a
+    zstd compressor is passed. It writes to disk through a large buffer, so
+    compressed data is written in few large chunks.
+    """
+    fh = open(filename(epoch, compressor), "ab", buffering=WRITE_BUFFER_SIZE)
+    if compressor is not None:
+        return compressor.stream_writer(fh)
+    return gzip.GzipFile(fileobj=fh, mode="ab", compresslevel=1)
+
+def close_epoch_file(writer):
+    """Finish the compressed stream, then flush and close the underlying file"""
+    if isinstance(writer, gzip.GzipFile):
+        fh = writer.fileobj
+        writer.close()  # does not close a passed fileobj
+        fh.close()
+    else:
+        writer.close()  # zstd stream writers close the underlying file with them
+
+def serialize_entry(ts, client, export, flows):
+    """Serialize the filtered flows of an export to one line of an epoch file"""
+    entry = {ts: {
+        "client": client,
+        "header": export.header.to_dict(),
+        "flows": flows}
+    }
+    try:
+        # Float timestamp keys are serialized as strings, like json.dumps does
+        return orjson.dumps(entry, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+    except orjson.JSONEncodeError:
+        # v9 fields longer than eight bytes (e.g. IF_NAME) are decoded to integers
+        # beyond the 64 bit range of orjson, json handles those
+        return json.dumps(entry).encode() + b"\n"
+
+def cidr_blocks_from_request(response):
+    """Parse the CIDR blocks of a filter response into network objects once,
+    so that the per-flow checks do not have to parse them again.
+    """
     cidr_blocks = []
-    for data in response.json(): 
-        cidr_blocks.append(data["ip_range"])
+    for data in orjson.loads(response.content):
+        try:
+            cidr_blocks.append(ipaddress.ip_network(data["ip_range"]))
+        except ValueError:
+            logger.warning("Ignoring invalid CIDR block %r", data["ip_range"])
     return cidr_blocks
 
-def in_cidr_block(ip, cidr_blocks): 
-    for cidr in cidr_blocks: 
-        if ipaddress.ip_address(ip) in ipaddress.ip_network(cidr): 
+def fetch_cidr_blocks(session, url):
+    """Request the current CIDR blocks of the filter, None if the request failed"""
+    response = session.get(url, timeout=REQUEST_TIMEOUT)
+    if response.status_code != 200:
+        logger.warning("Fetching the CIDR blocks failed with status %d", response.status_code)
+        return None
+    return cidr_blocks_from_request(response)
+
+def upload_and_delete(session, url, path, client_id):
+    """Upload a finished epoch file, retrying up to three times, and delete it.
+    Runs in the upload worker thread, so the collector keeps processing packets meanwhile.
+    """
+    try:
+        for i in range(0, 4):
+            try:
+                # Reopened for every attempt, a failed POST has already consumed the file
+                with open(path, 'rb') as fh:
+                    r = session.post(url, files={'file': fh}, data={'clientId': client_id},
+                                     timeout=REQUEST_TIMEOUT)
+                if r.status_code == 200:
+                    break
+                error = "status {}".format(r.status_code)
+            except requests.RequestException as e:
+                # Network errors count as a failed attempt as well
+                error = e
+            if i < 3:
+                time.sleep(i + 1)
+        else:
+            logger.error("Uploading %s failed: %s", path, error)
+        os.remove(path)
+    except Exception as e:
+        logger.error("Uploading %s failed: %s", path, e)
+
+def contains_templates(data):
+    """Check if a raw v9/IPFIX export contains template sets, which must always be parsed.
+    Set IDs below 256 are (options) template sets, data sets use the ID of their template.
+    """
+    version = struct.unpack_from('!H', data)[0]
+    if version in (1, 5):
+        return False
+    if version not in (9, 10):
+        return True  # let the parser report it
+    offset = 20 if version == 9 else 16  # header length
+    end = len(data)
+    while offset + 4 <= end:
+        set_id, length = struct.unpack_from('!HH', data, offset)
+        if set_id < 256 or length == 0:
             return True
+        offset += length
     return False
 
+def ip_to_int(ip):
+    """Convert an IPv4 address from a flow to its integer value.
+    v1/v5 already carry integers, v9 carries the dotted string representation.
+    """
+    if type(ip) == int:
+        return ip
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+class CIDRFilter:
+    """Prefix lookup table for the IPv4 CIDR blocks of the filter.
+
+    Single host (/32) blocks are kept in a set of address integers, which is
+    probed first with one hash lookup. All other networks are stored as sets of
+    their network prefixes, one set per prefix length. A lookup shifts the
+    address once per distinct prefix length and probes the matching set,
+    instead of testing every network on its own.
+    IPv6 blocks are ignored, as only the IPv4 addresses of flows are checked.
+    """
+
+    # A raw packet prefilter is only built with up to this many two byte needles
+    MAX_NEEDLES = 256
+
+    # Number of cached lookup results. Flows of the same talkers repeat a lot, within and across exports
+    CACHE_SIZE = 65536
+
+    def __init__(self, cidr_blocks):
+        self._contains = functools.lru_cache(maxsize=self.CACHE_SIZE)(self._lookup)
+        self.update(cidr_blocks)
+
+    def update(self, cidr_blocks):
+        """Replace the filtered CIDR blocks and drop all cached lookup results"""
+        hosts = set()  # addresses of /32 blocks
+        prefixes = {}  # host bits -> set of network prefixes
+        for cidr in cidr_blocks:
+            if cidr.version != 4:
+                continue
+            if cidr.prefixlen == 32:
+                hosts.add(int(cidr.network_address))
+                continue
+            shift = 32 - cidr.prefixlen
+            prefixes.setdefault(shift, set()).add(int(cidr.network_address) >> shift)
+        self.hosts = hosts
+        self.prefixes = prefixes
+        self._tables = sorted(prefixes.items())
+        self._needles = self._build_needles(cidr_blocks)
+        self._contains.cache_clear()
+
+    def _build_needles(self, cidr_blocks):
+        """Collect the possible first two octets of all addresses in the filter,
+        as byte strings. None if there would be too many to be useful.
+        """
+        needles = set()
+        for cidr in cidr_blocks:
+            if cidr.version != 4:
+                continue
+            if cidr.prefixlen <= 8:
+                return None
+            first = int(cidr.network_address) >> 16
+            for prefix in range(first, first + (1 << max(0, 16 - cidr.prefixlen))):
+                needles.add(struct.pack('!H', prefix))
+            if len(needles) > self.MAX_NEEDLES:
+                return None
+        return tuple(needles)
+
+    def may_match(self, data):
+        """Check if any flow of a raw export packet could pass the filter, before parsing it.
+
+        Addresses are encoded as four bytes in network order, so a matching flow
+        always contains the first two octets of one of the filtered networks.
+        Packets which carry templates are always parsed, to keep the template cache up to date.
+        """
+        needles = self._needles
+        if needles is None:
+            return True
+        # Packets from the listener are memoryviews into a receive buffer starting at offset 0,
+        # search the underlying buffer instead of copying the data to bytes
+        buf = data.obj if isinstance(data, memoryview) else data
+        end = len(data)
+        for needle in needles:
+            if buf.find(needle, 0, end) != -1:
+                return True
+        return contains_templates(data)
+
+    def _lookup(self, ip):
+        ip = ip_to_int(ip)
+        if ip in self.hosts:
+            return True
+        for shift, prefixes in self._tables:
+            if ip >> shift in prefixes:
+                return True
+        return False
+
+    def __contains__(self, ip):
+        return self._contains(ip)
+
+    def filter(self, flows):
+        """Return the data dicts of all flows with a source or destination
+        address in the filter. Flows without IPv4 addresses are skipped.
+        """
+        contains = self._contains
+        matched = []
+        for flow in flows:
+            # The integer addresses are read without building the flow's data dict,
+            # which is only done for flows passing the filter. IPFIX records have no IPv4 accessors
+            src = getattr(flow, 'src_ip_int', None)
+            dst = getattr(flow, 'dst_ip_int', None)
+            if src is None or dst is None:
+                continue
+            if contains(src) or contains(dst):
+                matched.append(flow.data)
+        return matched
+
+    def __len__(self):
+        return len(self.hosts) + sum(len(prefixes) for prefixes in self.prefixes.values())
+
+
 if __name__ == "netflow.collector":
     logger.error("The collector is currently meant to be used as a CLI tool only.")
     logger.error("Use 'python3 -m netflow.collector -h' in your console for additional help.")
@@ -219,6 +746,12 @@ if __name__ == "__main__":
                         help="collector listening address")
     parser.add_argument("--port", "-p", type=int, default=2055,
                         help="collector listener port")
+    parser.add_argument("--receivers", type=int, default=1,
+                        help="number of receiver sockets sharing the port via SO_REUSEPORT")
+    parser.add_argument("--pin-cpus", action="store_true",
+                        help="pin the parser and receiver threads to separate CPUs")
+    parser.add_argument("--kernel-timestamps", action="store_true",
+                        help="timestamp packets with their kernel arrival time, at some cost per packet")
     parser.add_argument("--debug", "-D", action="store_true",
                         help="Enable debug output")
     args = parser.parse_args()
@@ -227,6 +760,8 @@ if __name__ == "__main__":
         logger.setLevel(logging.DEBUG)
         ch.setLevel(logging.DEBUG)
 
+    epoch_file = None  # compressed file of the current epoch, opened lazily on the first write
+    executor = None
     try:
         import configparser
         duration_of_cut = 300
@@ -234,48 +769,59 @@ if __name__ == "__main__":
         in_duration_epoch = current_epoch + duration_of_cut 
         config = configparser.ConfigParser()
         config.read('zerver.collector.ini') 
-        response = requests.get(config['WiseCritical']['FilterUrl'], headers={'Authorization': config['Customer']['AuthToken']})
-        data = response.json()
-        cidr_blocks = cidr_blocks_from_request(response)
-        if len(cidr_blocks) == 0: 
+        compressor = None  # gzip is used by default
+        if config.get('Collector', 'Compression', fallback='gzip') == 'zstd':
+            compressor = zstd_compressor(config.get('Collector', 'ZstdDictionary', fallback=None))
+        # Keep-alive session, reused for all requests to the API
+        session = requests.Session()
+        session.headers.update({'Authorization': config['Customer']['AuthToken']})
+        # Uploads and filter refreshes run in a single background thread
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        refresh = None  # future of the pending filter refresh
+        response = session.get(config['WiseCritical']['FilterUrl'], timeout=REQUEST_TIMEOUT)
+        cidr_filter = CIDRFilter(cidr_blocks_from_request(response))
+        if len(cidr_filter) == 0: 
             logger.info("Please add CIDR Blocks in the dashboard to start processing data")
-        for ts, client, export in get_export_packets(args.host, args.port):
+        # Everything allocated during startup lives until exit, keep it out of the garbage collector's
+        # generations. Exports rarely form reference cycles, so collections can be much less frequent
+        gc.collect()
+        gc.freeze()
+        gc.set_threshold(100000, 50, 50)
+        # Ticks every second without parsed exports, so epochs are rotated and uploaded without matching traffic
+        for packet in get_export_packets(args.host, args.port, args.receivers,
+                                         cidr_filter.may_match, args.pin_cpus, tick=1.0,
+                                         kernel_timestamps=args.kernel_timestamps):
             try: 
-                flows = [] 
-                for flow in export.flows: 
-                    if in_cidr_block(flow.data['IPV4_SRC_ADDR'], cidr_blocks) or in_cidr_block(flow.data['IPV4_DST_ADDR'], cidr_blocks): 
-                        flows.append(flow.data)
-                entry = {ts: {
-                    "client": client,
-                    "header": export.header.to_dict(),
-                    "flows": flows}
-                }
+                if refresh is not None and refresh.done():
+                    future, refresh = refresh, None
+                    # A failed refresh keeps the current filter, the export is processed regardless
+                    if future.exception() is not None:
+                        logger.error("Refreshing the CIDR blocks failed: %s", future.exception())
+                    elif future.result() is not None:
+                        cidr_filter.update(future.result())
 
                 if time.time() > in_duration_epoch: 
-                    if os.path.exists(filename(current_epoch)): 
-                        files = {'file': open(filename(current_epoch),'rb')}
-                        data = {'clientId': config['Customer']['ID']}
-                        headers = {'Authorization': config['Customer']['AuthToken']}
-                        r = requests.post(config['WiseCritical']['ZerverUrl'], files=files, data=data, headers=headers)
-                        for i in range(0, 3):
-                            if( r.status_code == 200):
-                                break
-                            else:
-                                time.sleep(i+1)
-                                r = requests.post(config['WiseCritical']['ZerverUrl'], files=files, data=data)
-      
-                        os.remove(filename(current_epoch))
-                        response = requests.get(config['WiseCritical']['FilterUrl'], headers={'Authorization': config['Customer']['AuthToken']})
-                        if response.status_code == 200: 
-                            cidr_blocks = cidr_blocks_from_request(response)
+                    if epoch_file is not None:
+                        close_epoch_file(epoch_file)
+                        epoch_file = None
+                    if os.path.exists(filename(current_epoch, compressor)): 
+                        executor.submit(upload_and_delete, session, config['WiseCritical']['ZerverUrl'],
+                                        filename(current_epoch, compressor), config['Customer']['ID'])
+                        if refresh is None:
+                            refresh = executor.submit(fetch_cidr_blocks, session, config['WiseCritical']['FilterUrl'])
                     current_epoch = int(time.time())
                     in_duration_epoch = current_epoch + duration_of_cut 
+                if packet is None:
+                    continue
+
+                ts, client, export = packet
+                flows = cidr_filter.filter(export.flows)
                 if len(flows) > 0: 
-                    line = json.dumps(entry).encode() + b"\n"  # byte encoded line
-                    with gzip.open(filename(current_epoch), "ab") as fh:  # open as append, not reading the whole file
-                        data  = json.loads(str(line, 'UTF-8'))
-                        if in_cidr_block:
-                            fh.write(line)
+                    line = serialize_entry(ts, client, export, flows)
+                    if epoch_file is None:
+                        # Kept open for the whole epoch, so the compression stream is only set up once per file
+                        epoch_file = open_epoch_file(current_epoch, compressor)
+                    epoch_file.write(line)
             except Exception as e: 
                 logger.error(e)
 
@@ -283,3 +829,8 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logger.info("Received KeyboardInterrupt, passing through")
         pass
+    finally:
+        if epoch_file is not None:
+            close_epoch_file(epoch_file)
+        if executor is not None:
+            executor.shutdown(wait=True)  # finish running uploads
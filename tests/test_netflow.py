@@ -110,6 +110,7 @@ class TestFlowExportNetflow(unittest.TestCase):
             ipaddress.ip_address(flow.IPV4_SRC_ADDR),  # convert to ipaddress obj because value is int
             [ipaddress.ip_address("172.17.0.1"), ipaddress.ip_address("172.17.0.2")]  # matches multicast packet too
         )
+        self.assertEqual(flow.src_ip_int, flow.IPV4_SRC_ADDR)
         self.assertEqual(flow.PROTO, 1)  # ICMP
 
     def test_recv_v9_packet(self):
@@ -140,6 +141,9 @@ class TestFlowExportNetflow(unittest.TestCase):
         self.assertEqual(flow.PROTOCOL, 6)  # TCP
         self.assertEqual(flow.L4_SRC_PORT, 80)
         self.assertEqual(flow.IPV4_SRC_ADDR, "127.0.0.1")
+        # integer accessors, available without converting the rest of the flow
+        self.assertEqual(flow.src_ip_int, int(ipaddress.ip_address("127.0.0.1")))
+        self.assertEqual(ipaddress.ip_address(flow.dst_ip_int), ipaddress.ip_address(flow.IPV4_DST_ADDR))
 
         flow = p.export.flows[-1]  # last flow
         self.assertEqual(flow.PROTOCOL, 17)  # UDP
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+"""
+This file belongs to https://github.com/bitkeks/python-netflow-v9-softflowd.
+
+Copyright 2016-2020 Dominik Pataky <software+pynetflow@dpataky.eu>
+Licensed under MIT License. See LICENSE.
+"""
+import ipaddress
+import json
+import os
+import queue
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from netflow.utils import parse_packet
+from tests.lib import emit_packets, CONNECTION, \
+    PACKET_IPFIX_TEMPLATE, PACKET_V1, PACKET_V5, PACKET_V9_TEMPLATE, PACKETS_V9
+
+try:
+    import requests
+    from netflow.wise_collector import CIDRFilter, SPSCRing, ThreadedNetFlowListener, contains_templates, \
+        serialize_entry, upload_and_delete
+except ImportError:  # orjson and requests are only installed from requirements.txt
+    CIDRFilter = None
+
+
+def networks(*cidrs):
+    return [ipaddress.ip_network(cidr) for cidr in cidrs]
+
+
+def receive_buffer(packet, size=9216, fill=b"\x00"):
+    """Copy a hex packet to the start of a larger buffer, like the listener's receive buffers,
+    and return a memoryview of the packet
+    """
+    data = bytes.fromhex(packet)
+    buf = bytearray(fill * (size // len(fill)))
+    buf[:len(data)] = data
+    return memoryview(buf)[:len(data)]
+
+
+def flow_addresses(packet, templates):
+    """Collect the IPv4 source and destination addresses of all flows in a packet"""
+    addresses = set()
+    for flow in parse_packet(packet, templates).flows:
+        if flow.src_ip_int is not None:
+            addresses.add(ipaddress.ip_address(flow.src_ip_int))
+            addresses.add(ipaddress.ip_address(flow.dst_ip_int))
+    return addresses
+
+
+@unittest.skipIf(CIDRFilter is None, "orjson or requests are not installed")
+class TestCIDRFilter(unittest.TestCase):
+    def test_hosts(self):
+        """Test /32 blocks match only their own address, as string and as integer"""
+        cidr_filter = CIDRFilter(networks("172.17.0.2/32", "10.0.0.1/32"))
+        self.assertEqual(len(cidr_filter), 2)
+        self.assertIn("172.17.0.2", cidr_filter)
+        self.assertIn(int(ipaddress.ip_address("10.0.0.1")), cidr_filter)
+        self.assertNotIn("172.17.0.1", cidr_filter)
+        self.assertNotIn("10.0.0.0", cidr_filter)
+
+    def test_ranges(self):
+        """Test the first and last address of /9 to /15 blocks match, their neighbours do not"""
+        for prefixlen in range(9, 16):
+            network = ipaddress.ip_network("10.128.0.0/{}".format(prefixlen))
+            cidr_filter = CIDRFilter([network])
+            self.assertIn(str(network.network_address), cidr_filter)
+            self.assertIn(str(network.broadcast_address), cidr_filter)
+            self.assertNotIn(str(network.network_address - 1), cidr_filter)
+            self.assertNotIn(str(network.broadcast_address + 1), cidr_filter)
+
+    def test_ipv6_ignored(self):
+        """Test IPv6 blocks are not added to the filter"""
+        cidr_filter = CIDRFilter(networks("fe80::/64", "::1/128"))
+        self.assertEqual(len(cidr_filter), 0)
+        self.assertFalse(cidr_filter.may_match(receive_buffer(PACKET_V5)))
+
+    def test_update(self):
+        """Test lookups are cached, and the cache is dropped when the blocks are replaced"""
+        cidr_filter = CIDRFilter(networks("172.17.0.0/16"))
+        self.assertIn("172.17.0.1", cidr_filter)
+        self.assertIn("172.17.0.1", cidr_filter)
+        self.assertEqual(cidr_filter._contains.cache_info().hits, 1)
+        cidr_filter.update(networks("192.168.0.0/24"))
+        self.assertNotIn("172.17.0.1", cidr_filter)
+        self.assertIn("192.168.0.1", cidr_filter)
+
+    def test_filter(self):
+        """Test only the flows with a filtered source or destination address are returned"""
+        export = parse_packet(PACKET_V5)
+        cidr_filter = CIDRFilter(networks("172.17.0.2/32"))
+        flows = cidr_filter.filter(export.flows)
+        self.assertEqual(len(flows), 2)  # ping request and reply, not the multicast flow
+        for flow in flows:
+            self.assertIn(int(ipaddress.ip_address("172.17.0.2")), (flow["IPV4_SRC_ADDR"], flow["IPV4_DST_ADDR"]))
+
+        export = parse_packet(PACKET_V9_TEMPLATE, {"netflow": {}, "ipfix": {}})
+        flows = CIDRFilter(networks("127.0.0.0/8")).filter(export.flows)
+        self.assertEqual(len(flows), 8)
+        self.assertEqual({flow["IPV4_SRC_ADDR"] for flow in flows}, {"127.0.0.1"})
+
+
+@unittest.skipIf(CIDRFilter is None, "orjson or requests are not installed")
+class TestPrefilter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        """Test packets pass the prefilter for every flow address they contain, for hosts and ranges"""
+        templates = {"netflow": {}, "ipfix": {}}
+        parse_packet(PACKET_V9_TEMPLATE, templates)
+        for packet in [PACKET_V1, PACKET_V5] + PACKETS_V9:
+            addresses = flow_addresses(packet, templates)
+            self.assertTrue(addresses)
+            for address in addresses:
+                for prefixlen in (32, 24, 16, 15, 12, 9):
+                    network = ipaddress.ip_network("{}/{}".format(address, prefixlen), strict=False)
+                    cidr_filter = CIDRFilter([network])
+                    self.assertTrue(cidr_filter.may_match(receive_buffer(packet)), (network, packet[:8]))
+
+    def test_non_matching(self):
+        """Test v1, v5 and v9 data packets without a filtered address are discarded"""
+        cidr_filter = CIDRFilter(networks("198.51.100.0/24", "203.0.113.7/32"))
+        for packet in [PACKET_V1, PACKET_V5] + PACKETS_V9:
+            self.assertFalse(cidr_filter.may_match(receive_buffer(packet)))
+            self.assertFalse(cidr_filter.may_match(bytes.fromhex(packet)))
+
+    def test_searches_only_the_packet(self):
+        """Test the rest of a receive buffer is not searched, it still holds data of earlier packets"""
+        cidr_filter = CIDRFilter(networks("198.51.100.0/24"))
+        data = receive_buffer(PACKET_V5, fill=b"\xc6\x33")
+        self.assertEqual(data.obj.find(b"\xc6\x33"), len(data))
+        self.assertFalse(cidr_filter.may_match(data))
+
+    def test_large_networks_disable_prefilter(self):
+        """Test blocks of /8 and larger disable the prefilter, all packets are parsed"""
+        for cidr in ("10.0.0.0/8", "0.0.0.0/0"):
+            cidr_filter = CIDRFilter(networks("172.17.0.2/32", cidr))
+            for packet in [PACKET_V1, PACKET_V5] + PACKETS_V9:
+                self.assertTrue(cidr_filter.may_match(receive_buffer(packet)))
+
+    def test_template_bypass(self):
+        """Test packets with templates pass the prefilter, even without a filtered address"""
+        cidr_filter = CIDRFilter(networks("198.51.100.0/24"))
+        self.assertTrue(cidr_filter.may_match(receive_buffer(PACKET_V9_TEMPLATE)))
+        self.assertTrue(cidr_filter.may_match(receive_buffer(PACKET_IPFIX_TEMPLATE)))
+
+    def test_contains_templates(self):
+        self.assertTrue(contains_templates(receive_buffer(PACKET_V9_TEMPLATE)))
+        self.assertTrue(contains_templates(receive_buffer(PACKET_IPFIX_TEMPLATE)))
+        self.assertTrue(contains_templates(b"\x00\x07" + bytes(22)))  # unknown versions go to the parser
+        for packet in [PACKET_V1, PACKET_V5] + PACKETS_V9:
+            self.assertFalse(contains_templates(receive_buffer(packet)))
+
+
+@unittest.skipIf(CIDRFilter is None, "orjson or requests are not installed")
+class TestSPSCRing(unittest.TestCase):
+    def test_fifo(self):
+        ring = SPSCRing(4)
+        self.assertIsNone(ring.get())
+        for i in range(4):
+            self.assertTrue(ring.put(i))
+        self.assertFalse(ring.put(4))  # full
+        self.assertEqual(len(ring), 4)
+        self.assertEqual([ring.get() for _ in range(4)], [0, 1, 2, 3])
+        self.assertIsNone(ring.get())
+
+    def test_wraparound(self):
+        ring = SPSCRing(4)
+        items = []
+        for i in range(10):
+            self.assertTrue(ring.put(i))
+            self.assertTrue(ring.put(i + 100))
+            items.append(ring.get())
+            items.append(ring.get())
+        self.assertEqual(len(ring), 0)
+        self.assertEqual(items, [x for i in range(10) for x in (i, i + 100)])
+
+    def test_size(self):
+        with self.assertRaises(ValueError):
+            SPSCRing(6)
+
+
+@unittest.skipIf(CIDRFilter is None, "orjson or requests are not installed")
+class TestListener(unittest.TestCase):
+    def _send_recv_packets(self, packets, prefilter=None, kernel_timestamps=False):
+        listener = ThreadedNetFlowListener(*CONNECTION, prefilter=prefilter, kernel_timestamps=kernel_timestamps)
+        emit_packets(packets)
+        time.sleep(0.5)  # Allow packets to be sent and received
+        listener.start()
+        pkts = []
+        try:
+            while True:
+                pkts.append(listener.get(timeout=0.5))
+        except queue.Empty:
+            pass
+        finally:
+            listener.stop()
+            listener.join()
+        return pkts
+
+    def test_retry(self):
+        """Test packets received before their template are decoded once the template arrives"""
+        pkts = self._send_recv_packets(PACKETS_V9 + [PACKET_V9_TEMPLATE])
+        self.assertEqual(len(pkts), len(PACKETS_V9) + 1)
+        self.assertEqual(pkts[0].export.header.version, 9)
+        self.assertTrue(all(len(p.export.flows) > 0 for p in pkts))
+
+    def test_prefilter(self):
+        """Test packets discarded by the prefilter are not parsed, templates still are"""
+        cidr_filter = CIDRFilter(networks("172.17.0.0/16"))
+        pkts = self._send_recv_packets([PACKET_V9_TEMPLATE, PACKET_V1] + PACKETS_V9 + [PACKET_V5],
+                                       cidr_filter.may_match)
+        self.assertEqual([p.export.header.version for p in pkts], [9, 1, 5])
+
+    def test_timestamps(self):
+        """Test packets are timestamped when they were sent, not processed, with and without kernel timestamps"""
+        for kernel_timestamps in (False, True):
+            tstart = time.time()
+            pkts = self._send_recv_packets([PACKET_V1, PACKET_V5], kernel_timestamps=kernel_timestamps)
+            tend = time.time() - 0.5  # minus the delay before the listener is started
+            self.assertEqual(len(pkts), 2)
+            self.assertTrue(all(tstart < p.ts < tend for p in pkts))
+
+
+@unittest.skipIf(CIDRFilter is None, "orjson or requests are not installed")
+class TestSerializeEntry(unittest.TestCase):
+    def _entry(self, ts, client, export, flows):
+        return {ts: {"client": client, "header": export.header.to_dict(), "flows": flows}}
+
+    def test_format(self):
+        """Test entries are written as one line, with the timestamp key formatted like json.dumps does"""
+        export = parse_packet(PACKET_V5)
+        ts, client = 1602650000.123456, ("127.0.0.1", 2055)
+        flows = CIDRFilter(networks("172.17.0.0/16")).filter(export.flows)
+        line = serialize_entry(ts, client, export, flows)
+        self.assertTrue(line.endswith(b"\n"))
+        self.assertEqual(line.count(b"\n"), 1)
+        expected = json.dumps(self._entry(ts, client, export, flows))
+        self.assertEqual(list(json.loads(line.decode())), list(json.loads(expected)))  # the key, "1602650000.123456"
+        self.assertEqual(json.loads(line.decode()), json.loads(expected))
+
+    def test_large_integers(self):
+        """Test v9 fields longer than eight bytes, which exceed orjson's 64 bit integers, are still written"""
+        export = parse_packet(PACKET_V5)
+        flows = [{"IF_NAME": int.from_bytes(b"eth0.1234567890", "big"), "IN_BYTES": 100}]
+        line = serialize_entry(1602650000.5, ("127.0.0.1", 2055), export, flows)
+        self.assertTrue(line.endswith(b"\n"))
+        self.assertEqual(json.loads(line.decode())["1602650000.5"]["flows"], flows)
+
+
+class StubSession:
+    """Answers each POST with the next of the given status codes or exceptions"""
+    def __init__(self, *results):
+        self.results = list(results)
+        self.files = []
+        self.timeouts = []
+
+    def post(self, url, files, data, timeout=None):
+        fh = files["file"]
+        self.files.append((fh, fh.read()))
+        self.timeouts.append(timeout)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return mock.Mock(status_code=result)
+
+
+@unittest.skipIf(CIDRFilter is None, "orjson or requests are not installed")
+@mock.patch("netflow.wise_collector.time.sleep")
+class TestUpload(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".gz")
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(b"epoch data")
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _upload(self, session):
+        upload_and_delete(session, "http://localhost/upload", self.path, "client")
+        self.assertFalse(os.path.exists(self.path))
+        # The file is reopened and sent in full for every attempt, with a timeout
+        self.assertEqual(len({id(fh) for fh, _ in session.files}), len(session.files))
+        self.assertTrue(all(content == b"epoch data" for _, content in session.files))
+        self.assertTrue(all(timeout is not None for timeout in session.timeouts))
+
+    def test_success(self, sleep):
+        session = StubSession(200)
+        self._upload(session)
+        self.assertEqual(len(session.files), 1)
+        sleep.assert_not_called()
+
+    def test_retry_status(self, sleep):
+        session = StubSession(500, 200)
+        self._upload(session)
+        self.assertEqual(len(session.files), 2)
+
+    def test_retry_connection_error(self, sleep):
+        session = StubSession(requests.ConnectionError("refused"), 200)
+        self._upload(session)
+        self.assertEqual(len(session.files), 2)
+
+    def test_failure(self, sleep):
+        """Test the file is deleted and the failure is logged after four failed attempts"""
+        session = StubSession(500, requests.ConnectionError("refused"), requests.Timeout("timed out"), 503)
+        with self.assertLogs("netflow-collector", level="ERROR"):
+            self._upload(session)
+        self.assertEqual(len(session.files), 4)
+        self.assertEqual(sleep.call_count, 3)